@@ -1,80 +1,95 @@
 import streamlit as st
 from ollama_client import OllamaClient
+from conversation_store import ConversationStore
 import time
-import json
+import orjson
 import os
 import psutil
 from datetime import datetime
 from dotenv import load_dotenv
 from config import config
-import hashlib
+import hmac
+import secrets
 import re
+import csv
+import io
+import queue
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables
 load_dotenv()
 
 # Custom CSS for enhanced UI
-def load_custom_css():
-    st.markdown("""
-    <style>
-    /* Message styling */
-    .stChatMessage {
-        padding: 1rem;
-        border-radius: 10px;
-        margin-bottom: 1rem;
-    }
-    
-    /* Dark mode support */
-    @media (prefers-color-scheme: dark) {
-        .stApp {
-            background-color: #1a1a1a;
-        }
-    }
-    
-    /* Message actions */
-    .message-actions {
-        margin-top: 0.5rem;
-        padding-top: 0.5rem;
-        border-top: 1px solid rgba(128, 128, 128, 0.2);
-    }
-    
-    /* Timestamp styling */
-    .message-timestamp {
-        font-size: 0.8em;
-        color: #888;
-        margin-bottom: 0.5rem;
-    }
-    
-    /* Search box styling */
-    .search-box {
-        background: rgba(255,255,255,0.05);
-        border-radius: 20px;
-        padding: 0.5rem 1rem;
-        margin-bottom: 1rem;
-    }
-    
-    /* Tab styling */
-    .stTabs [data-baseweb="tab-list"] {
-        gap: 8px;
-    }
-    
-    .stTabs [data-baseweb="tab"] {
-        border-radius: 8px;
-        padding: 0.5rem 1rem;
-    }
-    
-    /* Copy text area styling */
-    .copy-text-area {
-        font-family: monospace;
-        font-size: 0.9em;
-        background-color: #f0f0f0;
-        border: 1px solid #ddd;
-        border-radius: 4px;
-        padding: 0.5rem;
-        margin-top: 0.5rem;
+CUSTOM_CSS = """
+<style>
+/* Message styling */
+.stChatMessage {
+    padding: 1rem;
+    border-radius: 10px;
+    margin-bottom: 1rem;
+}
+
+/* Dark mode support */
+@media (prefers-color-scheme: dark) {
+    .stApp {
+        background-color: #1a1a1a;
     }
-    </style>
-    """, unsafe_allow_html=True)
+}
+
+/* Message actions */
+.message-actions {
+    margin-top: 0.5rem;
+    padding-top: 0.5rem;
+    border-top: 1px solid rgba(128, 128, 128, 0.2);
+}
+
+/* Timestamp styling */
+.message-timestamp {
+    font-size: 0.8em;
+    color: #888;
+    margin-bottom: 0.5rem;
+}
+
+/* Search box styling */
+.search-box {
+    background: rgba(255,255,255,0.05);
+    border-radius: 20px;
+    padding: 0.5rem 1rem;
+    margin-bottom: 1rem;
+}
+
+/* Tab styling */
+.stTabs [data-baseweb="tab-list"] {
+    gap: 8px;
+}
+
+.stTabs [data-baseweb="tab"] {
+    border-radius: 8px;
+    padding: 0.5rem 1rem;
+}
+
+/* Copy text area styling */
+.copy-text-area {
+    font-family: monospace;
+    font-size: 0.9em;
+    background-color: #f0f0f0;
+    border: 1px solid #ddd;
+    border-radius: 4px;
+    padding: 0.5rem;
+    margin-top: 0.5rem;
+}
+</style>
+"""
+
+# Streamlit removes elements a rerun doesn't emit, so the stylesheet is
+# still sent every run; only building the string happens once, at import
+def load_custom_css():
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+
+# Login password, encoded once so each attempt is a constant-time bytes compare
+AUTH_PASSWORD_BYTES = config.auth_password.encode() if config.auth_password else None
 
 # Authentication
 def check_authentication():
@@ -86,10 +101,13 @@ def check_authentication():
     
     if not st.session_state.authenticated:
         st.title("🔐 Login Required")
-        password = st.text_input("Enter password:", type="password")
+        # A form so typing the password doesn't rerun the script
+        with st.form("login_form"):
+            password = st.text_input("Enter password:", type="password")
+            submitted = st.form_submit_button("Login")
         
-        if st.button("Login"):
-            if password == config.auth_password:
+        if submitted:
+            if AUTH_PASSWORD_BYTES is not None and hmac.compare_digest(password.encode(), AUTH_PASSWORD_BYTES):
                 st.session_state.authenticated = True
                 st.rerun()
             else:
@@ -98,14 +116,34 @@ def check_authentication():
     
     return True
 
-# System monitoring
+# System monitoring; cpu_percent(interval=None) reports usage since the
+# previous call without blocking, so prime it once at import
+psutil.cpu_percent(interval=None)
+
+@st.cache_data(ttl=2, show_spinner=False)
 def get_system_info():
     return {
-        "cpu_percent": psutil.cpu_percent(interval=1),
+        "cpu_percent": psutil.cpu_percent(interval=None),
         "memory_percent": psutil.virtual_memory().percent,
         "disk_percent": psutil.disk_usage('/').percent if os.name != 'nt' else psutil.disk_usage('C:').percent
     }
 
+# System tab blocks refresh themselves without rerunning the whole app
+@st.fragment(run_every=2.0)
+def system_metrics_fragment():
+    sys_info = get_system_info()
+    col1, col2 = st.columns(2)
+    with col1:
+        st.metric("CPU", f"{sys_info['cpu_percent']:.1f}%")
+        st.metric("Memory", f"{sys_info['memory_percent']:.1f}%")
+    with col2:
+        st.metric("Disk", f"{sys_info['disk_percent']:.1f}%")
+
+@st.fragment(run_every=2.0)
+def session_stats_fragment():
+    st.metric("Total Messages", st.session_state.stats['total'])
+    st.metric("Active Conversations", len(st.session_state.conversations))
+
 # Theme management
 def toggle_theme():
     if 'theme' not in st.session_state:
@@ -115,47 +153,598 @@ def toggle_theme():
 # Initialize conversation management
 def init_conversation_state():
     if 'conversations' not in st.session_state:
-        st.session_state.conversations = {}
+        st.session_state.conversations = load_conversations()
+    if 'search_index' not in st.session_state:
+        st.session_state.search_index = {}
+        st.session_state.search_grams = {}
+        st.session_state.indexed_messages = {}
+        for conv_id, conv_data in st.session_state.conversations.items():
+            for msg in conv_data['messages'] or []:
+                index_message(conv_id, msg)
+    if 'stats' not in st.session_state:
+        # Message totals across conversations, kept up to date as messages
+        # are added or removed
+        st.session_state.stats = {'total': 0, 'user': 0, 'assistant': 0}
+        for conv_data in st.session_state.conversations.values():
+            update_stats(conv_data['counts'])
+    if 'message_serial' not in st.session_state:
+        # Bumped on every change to any message, so cached exports can tell
+        # whether they are still current
+        st.session_state.message_serial = 0
+    if 'archived_search' not in st.session_state:
+        # (key, hits) of the last archive search, reused until the query, the
+        # archive or the set of unloaded conversations changes
+        st.session_state.archived_search = (None, {})
+    if 'conv_order' not in st.session_state:
+        # Conversation ids, most recently modified first
+        st.session_state.conv_order = sorted(
+            st.session_state.conversations,
+            key=lambda conv_id: st.session_state.conversations[conv_id]['last_modified'],
+            reverse=True
+        )
     if 'active_conversation' not in st.session_state:
-        st.session_state.active_conversation = 'default'
+        # Every session starts in a conversation of its own; opening the most
+        # recent one would let two sessions write into the same conversation
+        st.session_state.active_conversation = new_conversation_id()
     if st.session_state.active_conversation not in st.session_state.conversations:
-        st.session_state.conversations[st.session_state.active_conversation] = {
-            'messages': [],
-            'created_at': datetime.now(),
-            'last_modified': datetime.now(),
-            'title': 'New Chat'
-        }
+        create_conversation(st.session_state.active_conversation)
+
+def load_conversations():
+    # Archived conversations start with only their metadata; messages are
+    # loaded when the conversation is first opened
+    conversations = {}
+    if history_store:
+        for conv_id, meta in history_store.conversations().items():
+            try:
+                conversations[conv_id] = {
+                    'messages': None,
+                    'created_at': datetime.fromisoformat(meta['created_at']),
+                    'last_modified': datetime.fromisoformat(meta['last_modified']),
+                    'title': meta['title'],
+                    'title_lower': meta['title'].lower(),
+                    'counts': dict(meta.get('counts', {}))
+                }
+            except (KeyError, TypeError, ValueError):
+                # A damaged index entry shouldn't keep the app from starting
+                continue
+    return conversations
+
+def conversation_meta(conv):
+    return {
+        'title': conv['title'],
+        'created_at': conv['created_at'].isoformat(),
+        'last_modified': conv['last_modified'].isoformat(),
+        'counts': conv['counts']
+    }
+
+def new_conversation_id():
+    # The random suffix keeps ids unique when several are made within a second
+    return f"chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{secrets.token_hex(4)}"
+
+def create_conversation(conversation_id):
+    # conv_order must hold each id once (it keys the sidebar buttons)
+    if conversation_id in st.session_state.conversations:
+        touch_conversation(conversation_id)
+        return
+    
+    st.session_state.conversations[conversation_id] = {
+        'messages': [],
+        'created_at': datetime.now(),
+        'last_modified': datetime.now(),
+        'title': 'New Chat',
+        'title_lower': 'new chat',
+        'counts': {'user': 0, 'assistant': 0}
+    }
+    st.session_state.conv_order.insert(0, conversation_id)
+
+def touch_conversation(conversation_id):
+    # The touched conversation is now the most recent one, so it moves to the
+    # front instead of re-sorting the whole list
+    st.session_state.conversations[conversation_id]['last_modified'] = datetime.now()
+    conv_order = st.session_state.conv_order
+    if conv_order and conv_order[0] != conversation_id:
+        conv_order.remove(conversation_id)
+        conv_order.insert(0, conversation_id)
+
+def set_active_conversation(conversation_id):
+    previous = st.session_state.active_conversation
+    st.session_state.active_conversation = conversation_id
+    
+    # With an archive on disk only the active conversation stays in memory
+    if history_store and previous != conversation_id and previous in st.session_state.conversations:
+        conv = st.session_state.conversations[previous]
+        if conv['messages'] is not None:
+            unindex_conversation(previous)
+            conv['messages'] = None
+
+def update_stats(counts, sign=1):
+    stats = st.session_state.stats
+    for role, count in counts.items():
+        stats['total'] += sign * count
+        stats[role] = stats.get(role, 0) + sign * count
+
+def delete_conversation(conversation_id):
+    update_stats(st.session_state.conversations[conversation_id]['counts'], sign=-1)
+    unindex_conversation(conversation_id)
+    st.session_state.message_serial += 1
+    del st.session_state.conversations[conversation_id]
+    st.session_state.conv_order.remove(conversation_id)
+    if history_store:
+        history_store.delete(conversation_id)
 
 # Message management functions
+def build_message(role, content, timestamp=None, msg_id=None):
+    # Display strings are formatted once here instead of on every render
+    sent_at = datetime.fromisoformat(timestamp) if timestamp else datetime.now()
+    return {
+        "role": role,
+        "content": content,
+        "content_lower": content.lower(),
+        "timestamp": sent_at.isoformat(),
+        "hms": sent_at.strftime('%H:%M:%S'),
+        "iso_human": sent_at.strftime('%Y-%m-%d %H:%M:%S'),
+        "id": msg_id or secrets.token_hex(4)
+    }
+
+def load_messages(conversation_id):
+    # Messages of a conversation, read from the archive if not in memory
+    messages = st.session_state.conversations[conversation_id]['messages']
+    if messages is None:
+        messages = [
+            build_message(m['role'], m['content'], m['timestamp'], m['id'])
+            for m in history_store.load_messages(conversation_id)
+        ]
+    return messages
+
+def get_messages(conversation_id):
+    # Messages of a conversation, loading them into memory on first access
+    conv = st.session_state.conversations[conversation_id]
+    if conv['messages'] is None:
+        conv['messages'] = load_messages(conversation_id)
+        for msg in conv['messages']:
+            index_message(conversation_id, msg)
+    return conv['messages']
+
 def add_message(role, content, conversation_id=None):
     if conversation_id is None:
         conversation_id = st.session_state.active_conversation
     
-    message = {
-        "role": role,
-        "content": content,
-        "timestamp": datetime.now().isoformat(),
-        "id": hashlib.md5(f"{role}{content}{datetime.now()}".encode()).hexdigest()[:8]
-    }
+    message = build_message(role, content)
     
-    st.session_state.conversations[conversation_id]['messages'].append(message)
-    st.session_state.conversations[conversation_id]['last_modified'] = datetime.now()
+    get_messages(conversation_id).append(message)
+    index_message(conversation_id, message)
+    st.session_state.message_serial += 1
+    touch_conversation(conversation_id)
     
     # Auto-generate title from first user message
-    if len(st.session_state.conversations[conversation_id]['messages']) == 1:
-        st.session_state.conversations[conversation_id]['title'] = content[:50] + "..." if len(content) > 50 else content
+    conv = st.session_state.conversations[conversation_id]
+    conv['counts'][role] = conv['counts'].get(role, 0) + 1
+    update_stats({role: 1})
+    if len(conv['messages']) == 1:
+        conv['title'] = content[:50] + "..." if len(content) > 50 else content
+        conv['title_lower'] = conv['title'].lower()
+    
+    if history_store:
+        history_store.append_message(conversation_id, message, conversation_meta(conv))
+
+# Search index: maps each word to the (conversation id, message id) pairs
+# containing it, so a search only has to verify candidate messages. Indexed
+# messages are also kept by (conversation id, message id), and every indexed
+# word is filed under its substrings of up to VOCAB_GRAM_SIZE characters, so
+# a partially typed word is matched without scanning the whole vocabulary.
+WORD_PATTERN = re.compile(r"\w+")
+VOCAB_GRAM_SIZE = 3
+
+def tokenize(text):
+    return WORD_PATTERN.findall(text.lower())
+
+def word_grams(word):
+    return {
+        word[i:i + n]
+        for n in range(1, min(VOCAB_GRAM_SIZE, len(word)) + 1)
+        for i in range(len(word) - n + 1)
+    }
+
+def index_message(conversation_id, message):
+    index = st.session_state.search_index
+    entry = (conversation_id, message['id'])
+    st.session_state.indexed_messages[entry] = message
+    for token in set(WORD_PATTERN.findall(message['content_lower'])):
+        postings = index.get(token)
+        if postings is None:
+            postings = index[token] = set()
+            for gram in word_grams(token):
+                st.session_state.search_grams.setdefault(gram, set()).add(token)
+        postings.add(entry)
+
+def unindex_message(conversation_id, message):
+    index = st.session_state.search_index
+    entry = (conversation_id, message['id'])
+    st.session_state.indexed_messages.pop(entry, None)
+    for token in set(WORD_PATTERN.findall(message['content_lower'])):
+        postings = index.get(token)
+        if postings is None:
+            continue
+        postings.discard(entry)
+        if not postings:
+            del index[token]
+            grams = st.session_state.search_grams
+            for gram in word_grams(token):
+                words = grams.get(gram)
+                if words is not None:
+                    words.discard(token)
+                    if not words:
+                        del grams[gram]
+
+def unindex_conversation(conversation_id):
+    for msg in st.session_state.conversations[conversation_id]['messages'] or []:
+        unindex_message(conversation_id, msg)
+
+def matching_words(query_token):
+    # Indexed words containing query_token: the words sharing all its grams,
+    # checked for the whole token
+    grams = st.session_state.search_grams
+    n = min(VOCAB_GRAM_SIZE, len(query_token))
+    word_sets = []
+    for gram in {query_token[i:i + n] for i in range(len(query_token) - n + 1)}:
+        words = grams.get(gram)
+        if not words:
+            return []
+        word_sets.append(words)
+    word_sets.sort(key=len)
+    return [word for word in word_sets[0].intersection(*word_sets[1:]) if query_token in word]
+
+def search_messages(query, include_archived=True):
+    query_lower = query.lower()
+    index = st.session_state.search_index
+    
+    # Intersect the postings of every query word; a word typed so far may only
+    # be part of an indexed word
+    candidates = None
+    for query_token in set(tokenize(query)):
+        postings = set()
+        for word in matching_words(query_token):
+            postings |= index[word]
+        candidates = postings if candidates is None else candidates & postings
+        if not candidates:
+            break
+    
+    # Verify the phrase on candidates only (full scan if the query has no words)
+    if candidates is None:
+        loaded = [
+            (conv_id, msg)
+            for conv_id, conv_data in st.session_state.conversations.items()
+            for msg in conv_data['messages'] or []
+        ]
+    else:
+        lookup = st.session_state.indexed_messages
+        loaded = [(conv_id, lookup[(conv_id, msg_id)]) for conv_id, msg_id in candidates]
+    matches = [(conv_id, msg) for conv_id, msg in loaded if query_lower in msg['content_lower']]
+    
+    # Conversations not loaded in memory are searched in the archive files
+    archived_hits = {}
+    if include_archived and history_store:
+        unloaded = frozenset(
+            conv_id for conv_id, conv_data in st.session_state.conversations.items()
+            if conv_data['messages'] is None
+        )
+        key = (query, history_store.version, unloaded)
+        cached_key, archived_hits = st.session_state.archived_search
+        if cached_key != key:
+            archived_hits = history_store.search(query, unloaded)
+            st.session_state.archived_search = (key, archived_hits)
+    
+    for conv_id, archived in archived_hits.items():
+        matches.extend(
+            (conv_id, build_message(m['role'], m['content'], m['timestamp'], m['id']))
+            for m in archived
+        )
+    
+    # Candidates come from a set, so put the hits back in chronological order
+    matches.sort(key=lambda match: match[1]['timestamp'])
+    return [
+        {
+            'conversation': conv_id,
+            'message': msg,
+            'context': st.session_state.conversations[conv_id]['title']
+        }
+        for conv_id, msg in matches
+    ]
+
+# Search result snippets: the first hit is bolded by slicing around its
+# offset, so rendering cost doesn't grow with the message length
+SNIPPET_RADIUS = 200
+
+def highlight_snippet(message, query_lower):
+    content = message['content']
+    idx = message['content_lower'].find(query_lower)
+    if idx < 0:
+        return content[:2 * SNIPPET_RADIUS]
+    
+    end = idx + len(query_lower)
+    start = max(0, idx - SNIPPET_RADIUS)
+    stop = min(len(content), end + SNIPPET_RADIUS)
+    return (
+        ("…" if start > 0 else "")
+        + content[start:idx] + "**" + content[idx:end] + "**" + content[end:stop]
+        + ("…" if stop < len(content) else "")
+    )
+
+# Streaming output; the placeholder is repainted at most every
+# STREAM_FLUSH_INTERVAL seconds (or on a newline) rather than on every chunk
+STREAM_FLUSH_INTERVAL = 0.03
 
-def search_messages(query):
-    results = []
-    for conv_id, conv_data in st.session_state.conversations.items():
+def stream_to_placeholder(placeholder, chunks):
+    full_response = ""
+    last_flush = time.monotonic()
+    
+    for chunk in chunks:
+        full_response += chunk
+        now = time.monotonic()
+        if now - last_flush >= STREAM_FLUSH_INTERVAL or "\n" in chunk:
+            placeholder.markdown(full_response + "▌")
+            last_flush = now
+    
+    placeholder.markdown(full_response)
+    return full_response
+
+def stream_to_placeholders(placeholders, streams):
+    # Each stream is consumed on its own worker thread so the requests to
+    # Ollama overlap; chunks come back through a queue and every Streamlit
+    # call stays on the script thread
+    updates = queue.Queue()
+    # Set when the script thread stops draining (e.g. Streamlit aborts the
+    # run for a rerun or Stop), so the pumps drop their streams
+    stop = threading.Event()
+    
+    def pump(idx, chunks):
+        try:
+            for chunk in chunks:
+                if stop.is_set():
+                    break
+                updates.put((idx, chunk))
+        except Exception as e:
+            updates.put((idx, f"Error: {str(e)}"))
+        finally:
+            # Closing the generator closes its HTTP response
+            chunks.close()
+            updates.put((idx, None))
+    
+    responses = [""] * len(streams)
+    last_flush = [time.monotonic()] * len(streams)
+    remaining = len(streams)
+    
+    executor = ThreadPoolExecutor(max_workers=len(streams))
+    futures = [executor.submit(pump, idx, chunks) for idx, chunks in enumerate(streams)]
+    try:
+        while remaining:
+            idx, chunk = updates.get()
+            if chunk is None:
+                placeholders[idx].markdown(responses[idx])
+                remaining -= 1
+                continue
+            
+            responses[idx] += chunk
+            now = time.monotonic()
+            if now - last_flush[idx] >= STREAM_FLUSH_INTERVAL or "\n" in chunk:
+                placeholders[idx].markdown(responses[idx] + "▌")
+                last_flush[idx] = now
+    finally:
+        # Don't wait for the pumps: an aborted run would otherwise block
+        # until every model finished its reply. Cancelling the futures by
+        # hand is what shutdown(cancel_futures=True) does on Python 3.9+.
+        stop.set()
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+    
+    return responses
+
+# Model context; only the most recent messages are sent verbatim, older ones
+# are folded into a rolling summary cached on the conversation
+SUMMARY_PROMPT = (
+    "Summarize the following conversation in a few sentences. Keep facts, "
+    "names, decisions and open questions that later messages may refer to."
+)
+
+def summarize_messages(model, summary, messages):
+    transcript = "\n\n".join(f"{m['role'].title()}: {m['content']}" for m in messages)
+    if summary:
+        transcript = f"Earlier summary: {summary}\n\n{transcript}"
+    
+    result = ollama.chat(
+        model=model,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript}
+        ],
+        keep_alive=config.keep_alive
+    )
+    return None if result.startswith("Error:") else result
+
+def build_messages_for_model(conv, messages, system_prompt, model):
+    window = config.context_window_messages
+    summary_upto = conv.get('summary_upto_idx', 0)
+    
+    # Once the unsummarized tail outgrows the window, fold all but its most
+    # recent half into the summary so it isn't recomputed every turn
+    if len(messages) - summary_upto > window:
+        fold_upto = len(messages) - window // 2
+        with st.spinner("Summarizing earlier messages..."):
+            summary = summarize_messages(model, conv.get('summary'), messages[summary_upto:fold_upto])
+        if summary:
+            conv['summary'] = summary
+            conv['summary_upto_idx'] = summary_upto = fold_upto
+    
+    messages_for_model = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    if conv.get('summary'):
+        messages_for_model.append({"role": "system", "content": f"Prior summary: {conv['summary']}"})
+    # Only role/content go to Ollama; stored messages carry extra cached fields
+    # (content_lower, hms, ...) that would bloat the request
+    messages_for_model.extend(
+        {"role": m["role"], "content": m["content"]}
+        for m in itertools.islice(messages, summary_upto, None)
+    )
+    return messages_for_model
+
+def invalidate_summary(conv, index):
+    # Changing a message that was already folded in makes the summary stale
+    if index < conv.get('summary_upto_idx', 0):
+        conv.pop('summary', None)
+        conv['summary_upto_idx'] = 0
+
+# Button callbacks; they run before the script, so the rerun a click triggers
+# already sees the new state and no extra st.rerun() is needed
+def set_state(key, value):
+    st.session_state[key] = value
+
+def save_edit(conv_id, i):
+    conv = st.session_state.conversations[conv_id]
+    message = conv['messages'][i]
+    edited_content = st.session_state[f"edit_text_{message['id']}"]
+    
+    unindex_message(conv_id, message)
+    message["content"] = edited_content
+    message["content_lower"] = edited_content.lower()
+    st.session_state.message_serial += 1
+    conv.pop('context', None)
+    invalidate_summary(conv, i)
+    index_message(conv_id, message)
+    if history_store:
+        history_store.edit_message(conv_id, message['id'], edited_content)
+    st.session_state[f"editing_{message['id']}"] = False
+
+def new_conversation():
+    new_id = new_conversation_id()
+    create_conversation(new_id)
+    set_active_conversation(new_id)
+
+def remove_conversation(conversation_id):
+    if len(st.session_state.conversations) > 1:
+        delete_conversation(conversation_id)
+        if conversation_id == st.session_state.active_conversation:
+            set_active_conversation(st.session_state.conv_order[0])
+
+def set_system_prompt(prompt):
+    st.session_state.current_system_prompt = prompt
+
+def delete_custom_prompt(name):
+    del st.session_state.custom_prompts[name]
+
+def logout():
+    st.session_state.authenticated = False
+
+# Message rendering; each message is its own fragment so interacting with one
+# row (copy, edit) reruns only that row instead of the whole conversation
+@st.fragment
+def render_message(conv_id, i, message):
+    conv = st.session_state.conversations[conv_id]
+    msg_id = message["id"]
+    with st.chat_message(message["role"]):
+        # Timestamp
+        st.caption(message['hms'])
+        
+        # Message content
+        st.markdown(message["content"])
+        
+        # Message actions are only built once the row's toggle is opened
+        acts_key = f"acts_open_{msg_id}"
+        st.button(
+            "⋯", key=f"acts_{msg_id}", help="Actions",
+            on_click=set_state, args=(acts_key, not st.session_state.get(acts_key, False))
+        )
+        
+        if st.session_state.get(acts_key, False):
+            col1, col2, col3 = st.columns(3)
+            
+            with col1:
+                # Copy functionality using text_area for reliable copying
+                st.button("📋 Copy", key=f"copy_btn_{msg_id}", on_click=set_state, args=(f"show_copy_{msg_id}", True))
+                
+                if st.session_state.get(f"show_copy_{msg_id}", False):
+                    st.text_area(
+                        "Copy this text (Ctrl+A to select all, then Ctrl+C):",
+                        value=message["content"],
+                        height=100,
+                        key=f"copy_text_{msg_id}"
+                    )
+                    st.button("✓ Done", key=f"done_copy_{msg_id}", on_click=set_state, args=(f"show_copy_{msg_id}", False))
+            
+            with col2:
+                if message["role"] == "assistant":
+                    if st.button("🔄 Regenerate", key=f"regen_{msg_id}"):
+                        # Remove this and subsequent messages; the message list
+                        # changes, so the whole app has to rerun
+                        for removed in conv['messages'][i:]:
+                            unindex_message(conv_id, removed)
+                            conv['counts'][removed['role']] -= 1
+                            update_stats({removed['role']: 1}, sign=-1)
+                        conv['messages'] = conv['messages'][:i]
+                        st.session_state.message_serial += 1
+                        conv.pop('context', None)
+                        invalidate_summary(conv, i)
+                        if history_store:
+                            history_store.truncate(conv_id, msg_id, conversation_meta(conv))
+                        st.rerun()
+            
+            with col3:
+                st.button("✏️ Edit", key=f"edit_{msg_id}", on_click=set_state, args=(f"editing_{msg_id}", True))
+            
+            # Edit mode
+            if st.session_state.get(f"editing_{msg_id}", False):
+                st.text_area(
+                    "Edit message:",
+                    value=message["content"],
+                    key=f"edit_text_{msg_id}"
+                )
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.button("💾 Save", key=f"save_edit_{msg_id}", on_click=save_edit, args=(conv_id, i))
+                with col2:
+                    st.button("❌ Cancel", key=f"cancel_edit_{msg_id}", on_click=set_state, args=(f"editing_{msg_id}", False))
+
+# Export builders; each writes straight into a bytes buffer
+EXPORT_MESSAGE_FIELDS = ("role", "content", "timestamp", "id")
+
+def export_conversation(conv, messages):
+    return {
+        'title': conv['title'],
+        # str() keeps the "YYYY-MM-DD HH:MM:SS" form exports have always had;
+        # orjson would otherwise write ISO 8601 with a "T"
+        'created_at': str(conv['created_at']),
+        'last_modified': str(conv['last_modified']),
+        'messages': [{field: msg[field] for field in EXPORT_MESSAGE_FIELDS} for msg in messages]
+    }
+
+def export_json(export_data):
+    return orjson.dumps(export_data, option=orjson.OPT_INDENT_2)
+
+def export_markdown(export_data):
+    parts = []
+    for conv_data in export_data.values():
+        parts.append(f"# {conv_data['title']}\n\n")
+        for msg in conv_data['messages']:
+            role = "User" if msg['role'] == 'user' else "Assistant"
+            parts.append(f"**{role}**: {msg['content']}\n\n")
+        parts.append("---\n\n")
+    return "".join(parts).encode("utf-8")
+
+def export_csv(export_data):
+    buffer = io.BytesIO()
+    text = io.TextIOWrapper(buffer, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    writer.writerow(["Conversation", "Timestamp", "Role", "Content"])
+    for conv_data in export_data.values():
         for msg in conv_data['messages']:
-            if query.lower() in msg['content'].lower():
-                results.append({
-                    'conversation': conv_id,
-                    'message': msg,
-                    'context': conv_data['title']
-                })
-    return results
+            writer.writerow([
+                conv_data['title'],
+                msg.get('timestamp', ''),
+                msg['role'],
+                msg['content']
+            ])
+    text.flush()
+    text.detach()
+    return buffer.getvalue()
 
 # Page configuration
 st.set_page_config(
@@ -179,6 +768,28 @@ def get_ollama_client():
 
 ollama = get_ollama_client()
 
+# Ollama HTTP probes are cached briefly so reruns (e.g. while streaming)
+# don't each hit the server
+@st.cache_data(ttl=5, show_spinner=False)
+def cached_is_available():
+    return ollama.is_available()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_list_models():
+    return ollama.list_models()
+
+def refresh_models():
+    # The client keeps its own short-lived copy of the list too
+    ollama.clear_model_cache()
+    cached_list_models.clear()
+
+# Conversation archive (optional)
+@st.cache_resource
+def get_conversation_store():
+    return ConversationStore(config.history_dir)
+
+history_store = get_conversation_store() if config.persist_conversations else None
+
 # Initialize conversation state
 init_conversation_state()
 
@@ -189,20 +800,16 @@ with col1:
     st.markdown("Enhanced AI chat experience with Ollama")
 
 with col2:
-    if st.button("🌓 Theme", help="Toggle dark/light theme"):
-        toggle_theme()
-        st.rerun()
+    st.button("🌓 Theme", help="Toggle dark/light theme", on_click=toggle_theme)
 
 with col3:
     if config.enable_auth:
-        if st.button("🚪 Logout"):
-            st.session_state.authenticated = False
-            st.rerun()
+        st.button("🚪 Logout", on_click=logout)
 
 # Sidebar configuration with tabs
 with st.sidebar:
     # Connection status at the top
-    if ollama.is_available():
+    if cached_is_available():
         st.success("✅ Ollama Connected")
     else:
         st.error("❌ Ollama Disconnected")
@@ -218,16 +825,7 @@ with st.sidebar:
         st.markdown("### Conversations")
         
         # New conversation button
-        if st.button("➕ New Conversation", use_container_width=True, type="primary"):
-            new_id = f"chat_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-            st.session_state.conversations[new_id] = {
-                'messages': [],
-                'created_at': datetime.now(),
-                'last_modified': datetime.now(),
-                'title': 'New Chat'
-            }
-            st.session_state.active_conversation = new_id
-            st.rerun()
+        st.button("➕ New Conversation", use_container_width=True, type="primary", on_click=new_conversation)
         
         # Search conversations
         search_conv = st.text_input("🔍 Search conversations", placeholder="Type to search...")
@@ -236,32 +834,30 @@ with st.sidebar:
         st.markdown("#### Recent Chats")
         conversation_container = st.container()
         with conversation_container:
-            conversations_to_show = sorted(
-                st.session_state.conversations.items(),
-                key=lambda x: x[1]['last_modified'],
-                reverse=True
-            )
+            conversations_to_show = st.session_state.conv_order
             
             # Filter by search if provided
             if search_conv:
+                search_lower = search_conv.lower()
                 conversations_to_show = [
-                    (conv_id, conv_data) for conv_id, conv_data in conversations_to_show
-                    if search_conv.lower() in conv_data['title'].lower()
+                    conv_id for conv_id in conversations_to_show
+                    if search_lower in st.session_state.conversations[conv_id]['title_lower']
                 ]
             
             # Display conversations
-            for conv_id, conv_data in conversations_to_show[:20]:  # Limit to 20 most recent
+            for conv_id in conversations_to_show[:20]:  # Limit to 20 most recent
+                conv_data = st.session_state.conversations[conv_id]
                 col1, col2 = st.columns([5, 1])
                 with col1:
                     is_active = conv_id == st.session_state.active_conversation
-                    if st.button(
+                    st.button(
                         f"{'🔵' if is_active else '⚪'} {conv_data['title'][:30]}...", 
                         key=f"conv_{conv_id}",
                         use_container_width=True,
-                        disabled=is_active
-                    ):
-                        st.session_state.active_conversation = conv_id
-                        st.rerun()
+                        disabled=is_active,
+                        on_click=set_active_conversation,
+                        args=(conv_id,)
+                    )
                     
                     # Show last modified time
                     last_mod = conv_data['last_modified']
@@ -275,19 +871,14 @@ with st.sidebar:
                     st.caption(f"↳ {time_str}")
                 
                 with col2:
-                    if st.button("🗑️", key=f"del_{conv_id}", help="Delete"):
-                        if len(st.session_state.conversations) > 1:
-                            del st.session_state.conversations[conv_id]
-                            if conv_id == st.session_state.active_conversation:
-                                st.session_state.active_conversation = list(st.session_state.conversations.keys())[0]
-                            st.rerun()
+                    st.button("🗑️", key=f"del_{conv_id}", help="Delete", on_click=remove_conversation, args=(conv_id,))
     
     # Tab 2: Model Settings
     with sidebar_tabs[1]:
         st.markdown("### Model Configuration")
         
         # Model selection
-        models = ollama.list_models()
+        models = cached_list_models()
         if not models:
             st.error("No models found")
             st.markdown("Pull a model first:")
@@ -305,9 +896,7 @@ with st.sidebar:
             if selected_model:
                 st.markdown(f"**Active:** {selected_model}")
                 st.markdown(f"**Available:** {len(models)} models")
-                if st.button("🔄 Refresh Models"):
-                    st.cache_data.clear()
-                    st.rerun()
+                st.button("🔄 Refresh Models", on_click=refresh_models)
         
         # Model comparison
         st.markdown("### Advanced Options")
@@ -382,8 +971,7 @@ with st.sidebar:
         )
         
         # Apply template button
-        if st.button("Apply Template", use_container_width=True):
-            st.session_state.current_system_prompt = templates[template_choice]
+        st.button("Apply Template", use_container_width=True, on_click=set_system_prompt, args=(templates[template_choice],))
         
         # System prompt editor
         system_prompt = st.text_area(
@@ -411,34 +999,23 @@ with st.sidebar:
             for name in st.session_state.custom_prompts:
                 col1, col2 = st.columns([4, 1])
                 with col1:
-                    if st.button(f"📝 {name}", key=f"load_{name}", use_container_width=True):
-                        st.session_state.current_system_prompt = st.session_state.custom_prompts[name]
-                        st.rerun()
+                    st.button(
+                        f"📝 {name}", key=f"load_{name}", use_container_width=True,
+                        on_click=set_system_prompt, args=(st.session_state.custom_prompts[name],)
+                    )
                 with col2:
-                    if st.button("❌", key=f"del_prompt_{name}"):
-                        del st.session_state.custom_prompts[name]
-                        st.rerun()
+                    st.button("❌", key=f"del_prompt_{name}", on_click=delete_custom_prompt, args=(name,))
     
     # Tab 4: System & Analytics
     with sidebar_tabs[3]:
         st.markdown("### System Status")
         
         # System metrics
-        sys_info = get_system_info()
-        col1, col2 = st.columns(2)
-        with col1:
-            st.metric("CPU", f"{sys_info['cpu_percent']:.1f}%")
-            st.metric("Memory", f"{sys_info['memory_percent']:.1f}%")
-        with col2:
-            st.metric("Disk", f"{sys_info['disk_percent']:.1f}%")
-            if st.button("🔄 Refresh", key="refresh_metrics"):
-                st.rerun()
+        system_metrics_fragment()
         
         # Quick stats
         st.markdown("### Session Statistics")
-        total_messages = sum(len(conv['messages']) for conv in st.session_state.conversations.values())
-        st.metric("Total Messages", total_messages)
-        st.metric("Active Conversations", len(st.session_state.conversations))
+        session_stats_fragment()
         
         # Settings
         st.markdown("### Settings")
@@ -446,14 +1023,15 @@ with st.sidebar:
         # Theme toggle
         col1, col2 = st.columns(2)
         with col1:
-            if st.button("🌓 Toggle Theme", use_container_width=True):
-                toggle_theme()
-                st.rerun()
+            st.button("🌓 Toggle Theme", use_container_width=True, on_click=toggle_theme)
         
         with col2:
             if st.button("🗑️ Clear All", use_container_width=True):
                 if st.checkbox("Confirm clear all conversations"):
-                    st.session_state.conversations = {}
+                    for conv_id in list(st.session_state.conversations):
+                        delete_conversation(conv_id)
+                    st.session_state.search_index = {}
+                    st.session_state.conv_order = []
                     init_conversation_state()
                     st.rerun()
         
@@ -470,65 +1048,10 @@ with tab1:
     st.caption(f"📅 Created: {current_conv['created_at'].strftime('%Y-%m-%d %H:%M')}")
     
     # Display messages
-    messages = current_conv['messages']
+    messages = get_messages(st.session_state.active_conversation)
     
     for i, message in enumerate(messages):
-        with st.chat_message(message["role"]):
-            # Timestamp
-            if 'timestamp' in message:
-                st.caption(datetime.fromisoformat(message['timestamp']).strftime('%H:%M:%S'))
-            
-            # Message content
-            st.markdown(message["content"])
-            
-            # Message actions in an expander for cleaner UI
-            with st.expander("Actions", expanded=False):
-                col1, col2, col3 = st.columns(3)
-                
-                with col1:
-                    # Copy functionality using text_area for reliable copying
-                    if st.button("📋 Copy", key=f"copy_btn_{i}"):
-                        st.session_state[f"show_copy_{i}"] = True
-                    
-                    if st.session_state.get(f"show_copy_{i}", False):
-                        st.text_area(
-                            "Copy this text (Ctrl+A to select all, then Ctrl+C):",
-                            value=message["content"],
-                            height=100,
-                            key=f"copy_text_{i}"
-                        )
-                        if st.button("✓ Done", key=f"done_copy_{i}"):
-                            st.session_state[f"show_copy_{i}"] = False
-                            st.rerun()
-                
-                with col2:
-                    if message["role"] == "assistant":
-                        if st.button("🔄 Regenerate", key=f"regen_{i}"):
-                            # Remove this and subsequent messages
-                            current_conv['messages'] = messages[:i]
-                            st.rerun()
-                
-                with col3:
-                    if st.button("✏️ Edit", key=f"edit_{i}"):
-                        st.session_state[f"editing_{i}"] = True
-                
-                # Edit mode
-                if st.session_state.get(f"editing_{i}", False):
-                    edited_content = st.text_area(
-                        "Edit message:",
-                        value=message["content"],
-                        key=f"edit_text_{i}"
-                    )
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        if st.button("💾 Save", key=f"save_edit_{i}"):
-                            message["content"] = edited_content
-                            st.session_state[f"editing_{i}"] = False
-                            st.rerun()
-                    with col2:
-                        if st.button("❌ Cancel", key=f"cancel_edit_{i}"):
-                            st.session_state[f"editing_{i}"] = False
-                            st.rerun()
+        render_message(st.session_state.active_conversation, i, message)
 
     # Chat input
     if prompt := st.chat_input("Type your message..."):
@@ -539,38 +1062,47 @@ with tab1:
             st.markdown(prompt)
         
         # Generate response(s)
+        options = {
+            "temperature": temperature,
+            "num_predict": max_tokens,
+            "top_p": top_p,
+            "top_k": top_k,
+            "repeat_penalty": repeat_penalty
+        }
+        
+        # The cached context only holds the turns it was built from; drop it
+        # and let a successful generation store a fresh one
+        conv_context = current_conv.pop('context', None)
+        context_key = (selected_model, system_prompt)
+        if conv_context and len(conv_context) >= config.context_length * 3 // 4:
+            # Near the model's context length Ollama would silently cut the
+            # oldest tokens; resend the windowed history instead
+            conv_context = None
+        
         if compare_mode and compare_models:
             # Compare mode - generate from multiple models
-            responses = {}
             cols = st.columns(len(compare_models))
+            placeholders = []
             
             for idx, model in enumerate(compare_models):
                 with cols[idx]:
                     st.markdown(f"**{model}**")
                     with st.chat_message("assistant"):
-                        message_placeholder = st.empty()
-                        full_response = ""
-                        
-                        messages_for_model = [{"role": "system", "content": system_prompt}] if system_prompt else []
-                        messages_for_model.extend([{"role": m["role"], "content": m["content"]} for m in messages])
-                        messages_for_model.append({"role": "user", "content": prompt})
-                        
-                        for chunk in ollama.chat_stream(
-                            model=model,
-                            messages=messages_for_model,
-                            options={
-                                "temperature": temperature,
-                                "num_predict": max_tokens,
-                                "top_p": top_p,
-                                "top_k": top_k,
-                                "repeat_penalty": repeat_penalty
-                            }
-                        ):
-                            full_response += chunk
-                            message_placeholder.markdown(full_response + "▌")
-                        
-                        message_placeholder.markdown(full_response)
-                        responses[model] = full_response
+                        placeholders.append(st.empty())
+            
+            messages_for_model = build_messages_for_model(current_conv, messages, system_prompt, selected_model)
+            
+            # All models stream at once, so the wait is the slowest model
+            # rather than the sum of all of them
+            responses = dict(zip(compare_models, stream_to_placeholders(placeholders, [
+                ollama.chat_stream(
+                    model=model,
+                    messages=messages_for_model,
+                    options=options,
+                    keep_alive=config.keep_alive
+                )
+                for model in compare_models
+            ])))
             
             # Save the best response (from selected model)
             add_message("assistant", responses.get(selected_model, list(responses.values())[0]))
@@ -580,27 +1112,48 @@ with tab1:
             with st.chat_message("assistant"):
                 st.caption(datetime.now().strftime('%H:%M:%S'))
                 message_placeholder = st.empty()
-                full_response = ""
                 
-                messages_for_model = [{"role": "system", "content": system_prompt}] if system_prompt else []
-                messages_for_model.extend([{"role": m["role"], "content": m["content"]} for m in messages])
+                def save_context(tokens):
+                    current_conv['context'] = tokens
+                    current_conv['context_key'] = context_key
                 
-                try:
-                    for chunk in ollama.chat_stream(
+                if conv_context and current_conv.get('context_key') == context_key:
+                    # Continue from Ollama's cached context: only the new turn
+                    # is sent. The context holds every earlier turn verbatim, so
+                    # this bypasses the message window and summary of
+                    # build_messages_for_model until the context is dropped
+                    stream = ollama.generate_stream(
+                        model=selected_model,
+                        prompt=prompt,
+                        context=conv_context,
+                        on_context=save_context,
+                        options=options,
+                        keep_alive=config.keep_alive,
+                        **({"system": system_prompt} if system_prompt else {})
+                    )
+                elif len(messages) == 1:
+                    # First turn: start a context for the following turns
+                    stream = ollama.generate_stream(
+                        model=selected_model,
+                        prompt=prompt,
+                        on_context=save_context,
+                        options=options,
+                        keep_alive=config.keep_alive,
+                        **({"system": system_prompt} if system_prompt else {})
+                    )
+                else:
+                    # No usable context (model/prompt changed, history edited):
+                    # resend the full history
+                    messages_for_model = build_messages_for_model(current_conv, messages, system_prompt, selected_model)
+                    stream = ollama.chat_stream(
                         model=selected_model,
                         messages=messages_for_model,
-                        options={
-                            "temperature": temperature,
-                            "num_predict": max_tokens,
-                            "top_p": top_p,
-                            "top_k": top_k,
-                            "repeat_penalty": repeat_penalty
-                        }
-                    ):
-                        full_response += chunk
-                        message_placeholder.markdown(full_response + "▌")
-                    
-                    message_placeholder.markdown(full_response)
+                        options=options,
+                        keep_alive=config.keep_alive
+                    )
+                
+                try:
+                    full_response = stream_to_placeholder(message_placeholder, stream)
                     
                 except Exception as e:
                     st.error(f"Error: {str(e)}")
@@ -615,30 +1168,39 @@ with tab2:
     
     search_query = st.text_input("Search across all conversations:", placeholder="Enter search term...")
     
+    include_archived = False
+    if history_store:
+        # On by default: only the active conversation stays loaded, so
+        # without the archive scan the search would miss every other one
+        include_archived = st.checkbox(
+            "Include archived conversations",
+            value=True,
+            help="Also search conversations that are not loaded, by scanning the archive files"
+        )
+    
     if search_query:
-        results = search_messages(search_query)
+        results = search_messages(search_query, include_archived)
         
         if results:
             st.write(f"Found {len(results)} results:")
+            highlight_pattern = re.compile(re.escape(search_query), re.IGNORECASE)
             
             for result in results:
                 with st.expander(f"💬 {result['context']} - {result['message']['role'].title()}"):
                     st.caption(f"Conversation: {result['conversation']}")
-                    if 'timestamp' in result['message']:
-                        st.caption(f"Time: {datetime.fromisoformat(result['message']['timestamp']).strftime('%Y-%m-%d %H:%M:%S')}")
+                    st.caption(f"Time: {result['message']['iso_human']}")
                     
-                    # Highlight search term
-                    highlighted = re.sub(
-                        f"({re.escape(search_query)})",
-                        r"**\1**",
-                        result['message']['content'],
-                        flags=re.IGNORECASE
-                    )
-                    st.markdown(highlighted)
+                    # Highlight search term; only the text around the first
+                    # hit unless the whole message is asked for
+                    if st.checkbox("Show full message", key=f"full_{result['message']['id']}"):
+                        st.markdown(highlight_pattern.sub(r"**\g<0>**", result['message']['content']))
+                    else:
+                        st.markdown(highlight_snippet(result['message'], search_query.lower()))
                     
-                    if st.button(f"Go to conversation", key=f"goto_{result['message']['id']}"):
-                        st.session_state.active_conversation = result['conversation']
-                        st.rerun()
+                    st.button(
+                        f"Go to conversation", key=f"goto_{result['message']['id']}",
+                        on_click=set_active_conversation, args=(result['conversation'],)
+                    )
         else:
             st.info("No results found")
 
@@ -648,9 +1210,10 @@ with tab3:
     
     # Overall statistics
     total_conversations = len(st.session_state.conversations)
-    total_messages = sum(len(conv['messages']) for conv in st.session_state.conversations.values())
-    total_user_messages = sum(len([m for m in conv['messages'] if m['role'] == 'user']) for conv in st.session_state.conversations.values())
-    total_assistant_messages = sum(len([m for m in conv['messages'] if m['role'] == 'assistant']) for conv in st.session_state.conversations.values())
+    stats = st.session_state.stats
+    total_messages = stats['total']
+    total_user_messages = stats['user']
+    total_assistant_messages = stats['assistant']
     
     col1, col2, col3, col4 = st.columns(4)
     col1.metric("Total Conversations", total_conversations)
@@ -693,50 +1256,45 @@ with tab3:
     
     export_format = st.selectbox("Export Format:", ["JSON", "Markdown", "CSV"])
     include_all = st.checkbox("Include all conversations", value=False)
+    export_key = (export_format, include_all, st.session_state.active_conversation, st.session_state.message_serial)
     
+    # The export is built once when requested and kept in session state, so
+    # later reruns (including the download click itself) don't rebuild it
     if st.button("📥 Generate Export"):
         if include_all:
-            export_data = st.session_state.conversations
+            conv_ids = st.session_state.conv_order
         else:
-            export_data = {st.session_state.active_conversation: current_conv}
+            conv_ids = [st.session_state.active_conversation]
+        export_data = {
+            conv_id: export_conversation(st.session_state.conversations[conv_id], load_messages(conv_id))
+            for conv_id in conv_ids
+        }
         
         if export_format == "JSON":
-            export_content = json.dumps(export_data, indent=2, default=str)
+            export_content = export_json(export_data)
             mime_type = "application/json"
             file_ext = "json"
         elif export_format == "Markdown":
-            export_content = ""
-            for conv_id, conv_data in export_data.items():
-                export_content += f"# {conv_data['title']}\n\n"
-                for msg in conv_data['messages']:
-                    role = "User" if msg['role'] == 'user' else "Assistant"
-                    export_content += f"**{role}**: {msg['content']}\n\n"
-                export_content += "---\n\n"
+            export_content = export_markdown(export_data)
             mime_type = "text/markdown"
             file_ext = "md"
         else:  # CSV
-            import csv
-            import io
-            output = io.StringIO()
-            writer = csv.writer(output)
-            writer.writerow(["Conversation", "Timestamp", "Role", "Content"])
-            
-            for conv_id, conv_data in export_data.items():
-                for msg in conv_data['messages']:
-                    writer.writerow([
-                        conv_data['title'],
-                        msg.get('timestamp', ''),
-                        msg['role'],
-                        msg['content']
-                    ])
-            
-            export_content = output.getvalue()
+            export_content = export_csv(export_data)
             mime_type = "text/csv"
             file_ext = "csv"
         
+        st.session_state.export = {
+            'key': export_key,
+            'data': export_content,
+            'file_name': f"ollama_chat_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{file_ext}",
+            'mime': mime_type
+        }
+    
+    export = st.session_state.get('export')
+    if export and export['key'] == export_key:
         st.download_button(
             label=f"Download {export_format}",
-            data=export_content,
-            file_name=f"ollama_chat_export_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{file_ext}",
-            mime=mime_type
-        )
\ No newline at end of file
+            data=export['data'],
+            file_name=export['file_name'],
+            mime=export['mime']
+        )
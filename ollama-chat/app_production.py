@@ -1,17 +1,24 @@
 import streamlit as st
 from ollama_client import OllamaClient
 import time
-import json
+import threading
+import itertools
+from collections import deque
+import orjson
 import os
 import psutil
 from datetime import datetime
 from dotenv import load_dotenv
 from config import config
+import hmac
 import streamlit_authenticator as stauth
 
 # Load environment variables
 load_dotenv()
 
+# Login password, encoded once so each attempt is a constant-time bytes compare
+AUTH_PASSWORD_BYTES = config.auth_password.encode() if config.auth_password else None
+
 # Authentication (if enabled)
 def check_authentication():
     if not config.enable_auth:
@@ -22,10 +29,13 @@ def check_authentication():
     
     if not st.session_state.authenticated:
         st.title("🔐 Login Required")
-        password = st.text_input("Enter password:", type="password")
+        # A form so typing the password doesn't rerun the script
+        with st.form("login_form"):
+            password = st.text_input("Enter password:", type="password")
+            submitted = st.form_submit_button("Login")
         
-        if st.button("Login"):
-            if password == config.auth_password:
+        if submitted:
+            if AUTH_PASSWORD_BYTES is not None and hmac.compare_digest(password.encode(), AUTH_PASSWORD_BYTES):
                 st.session_state.authenticated = True
                 st.rerun()
             else:
@@ -34,14 +44,37 @@ def check_authentication():
     
     return True
 
-# System monitoring
-def get_system_info():
+# System monitoring; a background thread samples every
+# SYSTEM_SAMPLE_INTERVAL seconds and reruns only read its latest sample.
+# cpu_percent(interval=None) reports usage since the previous call without
+# blocking, so prime it once at import.
+SYSTEM_SAMPLE_INTERVAL = 2.0
+psutil.cpu_percent(interval=None)
+
+def sample_system_info():
     return {
-        "cpu_percent": psutil.cpu_percent(interval=1),
+        "cpu_percent": psutil.cpu_percent(interval=None),
         "memory_percent": psutil.virtual_memory().percent,
         "disk_percent": psutil.disk_usage('/').percent if os.name != 'nt' else psutil.disk_usage('C:').percent
     }
 
+@st.cache_resource
+def start_system_sampler():
+    # A plain dict shared by all sessions: the sampler thread has no script
+    # context, so it can't write to st.session_state
+    latest = {"info": sample_system_info()}
+    
+    def run():
+        while True:
+            time.sleep(SYSTEM_SAMPLE_INTERVAL)
+            latest["info"] = sample_system_info()
+    
+    threading.Thread(target=run, daemon=True).start()
+    return latest
+
+def get_system_info():
+    return start_system_sampler()["info"]
+
 # Page configuration
 st.set_page_config(
     page_title=config.app_title,
@@ -54,17 +87,119 @@ st.set_page_config(
 if not check_authentication():
     st.stop()
 
+# Older messages are folded into a running summary, SUMMARY_CHUNK at a time,
+# once more than SUMMARY_TRIGGER of them are unsummarized
+SUMMARY_TRIGGER = 20
+SUMMARY_CHUNK = 10
+SUMMARY_PROMPT = (
+    "Summarize the following dialogue in a few sentences. Keep facts, "
+    "names, decisions and open questions that later messages may refer to."
+)
+
+# Sidebar choices, built once instead of on every rerun
+_PRESETS = {
+    "Default": "",
+    "Code Helper": "You are an expert programmer. Provide clean, well-commented code with explanations.",
+    "Creative Writer": "You are a creative writer. Use vivid imagery and engaging storytelling.",
+    "Teacher": "You are a patient teacher. Explain concepts clearly with examples and check understanding.",
+    "Analyst": "You are a data analyst. Provide structured, evidence-based insights with clear reasoning."
+}
+_PRESET_KEYS = tuple(_PRESETS)
+
+_POPULAR_MODELS = (
+    "llama2:7b", "llama2:13b", "mistral:7b",
+    "codellama:7b", "phi:2.7b", "gemma:7b",
+    "neural-chat:7b", "starling-lm:7b"
+)
+
 # Helper functions
-def get_messages_with_system(system_prompt=None):
+def summarize_messages(model, summary, messages):
+    transcript = "\n\n".join(f"{m['role'].title()}: {m['content']}" for m in messages)
+    if summary:
+        transcript = f"Earlier summary: {summary}\n\n{transcript}"
+    
+    result = ollama.chat(
+        model=model,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript}
+        ]
+    )
+    return None if result.startswith("Error:") else result
+
+def update_summary(model):
+    history = st.session_state.messages
+    while len(history) - st.session_state.summary_cursor > SUMMARY_TRIGGER:
+        cursor = st.session_state.summary_cursor
+        with st.spinner("Summarizing earlier messages..."):
+            summary = summarize_messages(model, st.session_state.summary,
+                                         itertools.islice(history, cursor, cursor + SUMMARY_CHUNK))
+        if not summary:
+            # Send the unsummarized messages as they are and retry next turn
+            break
+        st.session_state.summary = summary
+        st.session_state.summary_cursor = cursor + SUMMARY_CHUNK
+
+def get_messages_with_system(system_prompt=None, model=None):
     messages = []
     if system_prompt and system_prompt.strip():
         messages.append({"role": "system", "content": system_prompt})
     
-    # Limit message history for performance
-    recent_messages = st.session_state.messages[-config.max_message_history:]
-    messages.extend(recent_messages)
+    # Only messages past the summary are sent verbatim; the ones before it
+    # are replaced by the summary
+    if model:
+        update_summary(model)
+    if st.session_state.summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation: {st.session_state.summary}"})
+    
+    messages.extend(itertools.islice(st.session_state.messages, st.session_state.summary_cursor, None))
     return messages
 
+def count_messages(messages):
+    stats = {"count": 0, "user_msgs": 0, "ai_msgs": 0, "total_chars": 0}
+    for m in messages:
+        stats["count"] += 1
+        stats["total_chars"] += len(m["content"])
+        if m["role"] == "user":
+            stats["user_msgs"] += 1
+        else:
+            stats["ai_msgs"] += 1
+    return stats
+
+def add_message(role, content):
+    # Keep the stats up to date as messages are appended, so the analytics
+    # block never has to walk the history
+    history = st.session_state.messages
+    stats = st.session_state.get("_stats")
+    if stats is not None and stats["count"] != len(history):
+        st.session_state.pop("_stats")
+        stats = None
+    
+    # A full history drops its oldest message on append; the summary cursor
+    # and the stats have to follow it
+    evicted = history[0] if len(history) == history.maxlen else None
+    history.append({"role": role, "content": content})
+    st.session_state.message_serial += 1
+    
+    if evicted is not None:
+        st.session_state.summary_cursor = max(0, st.session_state.summary_cursor - 1)
+        if stats is not None:
+            stats["count"] -= 1
+            stats["total_chars"] -= len(evicted["content"])
+            stats["user_msgs" if evicted["role"] == "user" else "ai_msgs"] -= 1
+    if stats is not None:
+        stats["count"] += 1
+        stats["total_chars"] += len(content)
+        stats["user_msgs" if role == "user" else "ai_msgs"] += 1
+
+def get_chat_stats():
+    # Recounted only if the history changed behind add_message's back
+    messages = st.session_state.messages
+    stats = st.session_state.get("_stats")
+    if stats is None or stats["count"] != len(messages):
+        stats = st.session_state["_stats"] = count_messages(messages)
+    return stats["user_msgs"], stats["ai_msgs"], stats["total_chars"]
+
 # Initialize Ollama client
 @st.cache_resource
 def get_ollama_client():
@@ -72,9 +207,20 @@ def get_ollama_client():
 
 ollama = get_ollama_client()
 
+# Model list, cached across reruns; the leading underscore keeps Streamlit
+# from hashing the client object on every rerun
+@st.cache_data(ttl=60, show_spinner=False)
+def get_available_models(_ollama):
+    return _ollama.list_models()
+
 # Initialize chat history early
+# Only the last max_message_history messages are kept; older ones drop off
+# the front of the deque
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=config.max_message_history)
+    st.session_state.message_serial = 0
+    st.session_state.summary = None
+    st.session_state.summary_cursor = 0
 
 # App header
 col1, col2 = st.columns([3, 1])
@@ -109,12 +255,8 @@ with st.sidebar:
             st.markdown(f"Check connection to: `{config.ollama_base_url}`")
             st.stop()
     
-    # Model selection with caching
-    @st.cache_data(ttl=60)  # Cache for 60 seconds
-    def get_available_models():
-        return ollama.list_models()
-    
-    models = get_available_models()
+    # Model selection
+    models = get_available_models(ollama)
     if models:
         selected_model = st.selectbox("🤖 Select Model", models)
     else:
@@ -147,17 +289,9 @@ with st.sidebar:
     )
     
     # Preset prompts
-    presets = {
-        "Default": "",
-        "Code Helper": "You are an expert programmer. Provide clean, well-commented code with explanations.",
-        "Creative Writer": "You are a creative writer. Use vivid imagery and engaging storytelling.",
-        "Teacher": "You are a patient teacher. Explain concepts clearly with examples and check understanding.",
-        "Analyst": "You are a data analyst. Provide structured, evidence-based insights with clear reasoning."
-    }
-    
-    selected_preset = st.selectbox("Quick Presets:", list(presets.keys()))
+    selected_preset = st.selectbox("Quick Presets:", _PRESET_KEYS)
     if st.button("Apply Preset"):
-        st.session_state.system_prompt = presets[selected_preset]
+        st.session_state.system_prompt = _PRESETS[selected_preset]
         st.rerun()
     
     # Model management (if enabled)
@@ -176,14 +310,8 @@ with st.sidebar:
                             st.error("Failed to unload")
         
         with st.expander("Pull New Model", expanded=False):
-            popular_models = [
-                "llama2:7b", "llama2:13b", "mistral:7b", 
-                "codellama:7b", "phi:2.7b", "gemma:7b",
-                "neural-chat:7b", "starling-lm:7b"
-            ]
-            
             st.markdown("**Popular Models:**")
-            for model in popular_models:
+            for model in _POPULAR_MODELS:
                 if st.button(f"📥 {model}", key=f"pull_{model}"):
                     st.info(f"Run: `ollama pull {model}`")
     
@@ -192,9 +320,7 @@ with st.sidebar:
         st.subheader("📊 Chat Analytics")
         
         # Statistics
-        user_msgs = len([m for m in st.session_state.messages if m["role"] == "user"])
-        ai_msgs = len([m for m in st.session_state.messages if m["role"] == "assistant"])
-        total_chars = sum(len(m["content"]) for m in st.session_state.messages)
+        user_msgs, ai_msgs, total_chars = get_chat_stats()
         
         col1, col2 = st.columns(2)
         col1.metric("Messages", f"{user_msgs + ai_msgs}")
@@ -203,63 +329,83 @@ with st.sidebar:
         # Export options
         with st.expander("💾 Export Chat", expanded=False):
             export_format = st.selectbox("Format:", ["JSON", "Markdown", "Text"])
+            export_key = (export_format, st.session_state.message_serial, selected_model, system_prompt,
+                          temperature, max_tokens, top_p, top_k)
             
-            if export_format == "JSON":
-                export_data = {
-                    "metadata": {
-                        "timestamp": datetime.now().isoformat(),
-                        "model": selected_model,
-                        "system_prompt": system_prompt,
-                        "parameters": {
-                            "temperature": temperature,
-                            "max_tokens": max_tokens,
-                            "top_p": top_p,
-                            "top_k": top_k
+            # The export is only built when asked for and kept in session state,
+            # so ordinary reruns (and the download click itself) skip it
+            if st.button("Prepare Export"):
+                now = datetime.now()
+                ts_compact = now.strftime('%Y%m%d_%H%M')
+                ts_human = now.strftime('%Y-%m-%d %H:%M')
+                messages = list(st.session_state.messages)
+                
+                if export_format == "JSON":
+                    export_data = {
+                        "metadata": {
+                            "timestamp": now.isoformat(),
+                            "model": selected_model,
+                            "system_prompt": system_prompt,
+                            "parameters": {
+                                "temperature": temperature,
+                                "max_tokens": max_tokens,
+                                "top_p": top_p,
+                                "top_k": top_k
+                            }
+                        },
+                        "messages": messages,
+                        "statistics": {
+                            "user_messages": user_msgs,
+                            "ai_messages": ai_msgs,
+                            "total_characters": total_chars
                         }
-                    },
-                    "messages": st.session_state.messages,
-                    "statistics": {
-                        "user_messages": user_msgs,
-                        "ai_messages": ai_msgs,
-                        "total_characters": total_chars
                     }
-                }
-                chat_data = json.dumps(export_data, indent=2)
-                filename = f"chat_export_{datetime.now().strftime('%Y%m%d_%H%M')}.json"
-            
-            elif export_format == "Markdown":
-                chat_data = f"# Chat Export\n\n"
-                chat_data += f"**Model:** {selected_model}\n"
-                chat_data += f"**Date:** {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
-                if system_prompt:
-                    chat_data += f"**System Prompt:** {system_prompt}\n\n"
-                chat_data += "---\n\n"
+                    chat_data = orjson.dumps(export_data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode()
+                    filename = f"chat_export_{ts_compact}.json"
                 
-                for msg in st.session_state.messages:
-                    role = "🧑 **User**" if msg["role"] == "user" else "🤖 **Assistant**"
-                    chat_data += f"{role}\n\n{msg['content']}\n\n---\n\n"
-                filename = f"chat_export_{datetime.now().strftime('%Y%m%d_%H%M')}.md"
-            
-            else:  # Text
-                chat_data = f"Chat Export - {datetime.now().strftime('%Y-%m-%d %H:%M')}\n"
-                chat_data += f"Model: {selected_model}\n"
-                chat_data += "="*60 + "\n\n"
+                elif export_format == "Markdown":
+                    parts = [f"# Chat Export\n\n**Model:** {selected_model}\n**Date:** {ts_human}\n\n"]
+                    if system_prompt:
+                        parts.append(f"**System Prompt:** {system_prompt}\n\n")
+                    parts.append("---\n\n")
+                    
+                    for msg in messages:
+                        role = "🧑 **User**" if msg["role"] == "user" else "🤖 **Assistant**"
+                        parts.append(f"{role}\n\n{msg['content']}\n\n---\n\n")
+                    chat_data = "".join(parts)
+                    filename = f"chat_export_{ts_compact}.md"
                 
-                for msg in st.session_state.messages:
-                    role = "USER" if msg["role"] == "user" else "ASSISTANT"
-                    chat_data += f"{role}: {msg['content']}\n\n"
-                filename = f"chat_export_{datetime.now().strftime('%Y%m%d_%H%M')}.txt"
+                else:  # Text
+                    parts = [f"Chat Export - {ts_human}\nModel: {selected_model}\n", "=" * 60, "\n\n"]
+                    
+                    for msg in messages:
+                        role = "USER" if msg["role"] == "user" else "ASSISTANT"
+                        parts.append(f"{role}: {msg['content']}\n\n")
+                    chat_data = "".join(parts)
+                    filename = f"chat_export_{ts_compact}.txt"
+                
+                st.session_state["_prep_export"] = {
+                    "key": export_key,
+                    "data": chat_data,
+                    "file_name": filename
+                }
             
-            st.download_button(
-                f"📥 Download {export_format}",
-                data=chat_data,
-                file_name=filename,
-                mime=f"text/{export_format.lower()}"
-            )
+            export = st.session_state.get("_prep_export")
+            if export and export["key"] == export_key:
+                st.download_button(
+                    f"📥 Download {export_format}",
+                    data=export["data"],
+                    file_name=export["file_name"],
+                    mime=f"text/{export_format.lower()}"
+                )
     
     # Clear chat
     if st.button("🗑️ Clear Chat", type="secondary", use_container_width=True):
-        st.session_state.messages = []
+        st.session_state.messages = deque(maxlen=config.max_message_history)
+        st.session_state.summary = None
+        st.session_state.summary_cursor = 0
+        st.session_state.pop("_stats", None)
+        st.session_state.pop("_prep_export", None)
         st.rerun()
 
 # Main chat interface
@@ -270,33 +416,31 @@ if system_prompt and system_prompt.strip():
     st.info(f"🎭 **Active Behavior:** {system_prompt[:100]}{'...' if len(system_prompt) > 100 else ''}")
 
 # Display message count warning
-if len(st.session_state.messages) > config.max_message_history:
+if len(st.session_state.messages) == st.session_state.messages.maxlen:
     st.warning(f"⚠️ Chat history limited to last {config.max_message_history} messages for performance")
 
 # Chat history
-for message in st.session_state.messages[-config.max_message_history:]:
+for message in st.session_state.messages:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
 # Chat input
 if prompt := st.chat_input("Type your message..."):
     # Add user message
-    st.session_state.messages.append({"role": "user", "content": prompt})
+    add_message("user", prompt)
     
     with st.chat_message("user"):
         st.markdown(prompt)
     
     # Generate response
     with st.chat_message("assistant"):
-        message_placeholder = st.empty()
-        full_response = ""
-        
         # Prepare messages with system prompt
-        messages_with_system = get_messages_with_system(system_prompt)
+        messages_with_system = get_messages_with_system(system_prompt, selected_model)
         
         try:
-            # Stream response
-            for chunk in ollama.chat_stream(
+            # Stream response; write_stream appends each chunk to the rendered
+            # text instead of re-sending the whole response every time
+            full_response = st.write_stream(ollama.chat_stream(
                 model=selected_model,
                 messages=messages_with_system,
                 options={
@@ -306,17 +450,12 @@ if prompt := st.chat_input("Type your message..."):
                     "top_k": top_k,
                     "repeat_penalty": repeat_penalty
                 }
-            ):
-                full_response += chunk
-                message_placeholder.markdown(full_response + "▌")
-            
-            # Final response
-            message_placeholder.markdown(full_response)
+            ))
             
         except Exception as e:
             st.error(f"Error generating response: {str(e)}")
             full_response = "Sorry, I encountered an error. Please try again."
-            message_placeholder.markdown(full_response)
+            st.markdown(full_response)
     
     # Add to history
-    st.session_state.messages.append({"role": "assistant", "content": full_response})
\ No newline at end of file
+    add_message("assistant", full_response)
\ No newline at end of file
@@ -1,6 +1,47 @@
 import os
 from dataclasses import dataclass, field
-from typing import Optional, Dict, List
+from functools import cached_property
+from types import MappingProxyType
+from typing import Optional, List, Mapping
+
+# Built once at import and read-only, so Config can hand them out without
+# copying
+_THEMES = MappingProxyType({
+    "blue": MappingProxyType({
+        "primary": "#0066cc",
+        "secondary": "#e3f2fd",
+        "accent": "#1976d2"
+    }),
+    "green": MappingProxyType({
+        "primary": "#2e7d32",
+        "secondary": "#e8f5e9",
+        "accent": "#388e3c"
+    }),
+    "purple": MappingProxyType({
+        "primary": "#6a1b9a",
+        "secondary": "#f3e5f5",
+        "accent": "#7b1fa2"
+    }),
+    "orange": MappingProxyType({
+        "primary": "#e65100",
+        "secondary": "#fff3e0",
+        "accent": "#ef6c00"
+    })
+})
+
+_DEFAULT_PROMPTS = MappingProxyType({
+    "Default": "",
+    "Code Expert": "You are an expert programmer. Provide clean, well-commented code with explanations.",
+    "Creative Writer": "You are a creative writer. Use vivid imagery and engaging storytelling.",
+    "Teacher": "You are a patient teacher. Explain concepts clearly with examples.",
+    "Analyst": "You are a data analyst. Provide structured, evidence-based insights.",
+    "Debugger": "You are a debugging assistant. Help identify and fix code issues systematically.",
+    "Translator": "You are a professional translator. Provide accurate, context-aware translations.",
+    "Technical Writer": "You are a technical writer. Create clear, structured documentation.",
+    "Code Reviewer": "You are a code reviewer. Analyze code for best practices, security, and performance.",
+    "Tutor": "You are a personal tutor. Adapt your teaching style to the student's needs.",
+    "Research Assistant": "You are a research assistant. Help gather, analyze, and synthesize information."
+})
 
 @dataclass
 class Config:
@@ -12,6 +53,9 @@ class Config:
     # App Configuration
     app_title: str = os.getenv("APP_TITLE", "Ollama Chat Interface")
     max_message_history: int = int(os.getenv("MAX_MESSAGE_HISTORY", "100"))
+    # Recent messages sent verbatim; older ones are summarized. At least 2,
+    # so the message just asked is never folded into the summary
+    context_window_messages: int = max(2, int(os.getenv("CONTEXT_WINDOW_MESSAGES", "12")))
     enable_model_management: bool = os.getenv("ENABLE_MODEL_MANAGEMENT", "true").lower() == "true"
     
     # Security
@@ -20,6 +64,9 @@ class Config:
     
     # Performance
     concurrent_requests: int = int(os.getenv("CONCURRENT_REQUESTS", "3"))
+    max_in_flight: int = int(os.getenv("MAX_IN_FLIGHT", os.getenv("CONCURRENT_REQUESTS", "3")))  # async chat requests sent at once; the rest wait
+    keep_alive: str = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # how long Ollama keeps the model (and its KV cache) loaded
+    context_length: int = int(os.getenv("OLLAMA_CONTEXT_LENGTH", "4096"))  # Ollama's context window, in tokens
     
     # UI/UX Features
     enable_dark_mode: bool = os.getenv("ENABLE_DARK_MODE", "true").lower() == "true"
@@ -36,6 +83,8 @@ class Config:
     # Conversation Management
     max_conversations: int = int(os.getenv("MAX_CONVERSATIONS", "50"))
     auto_save_interval: int = int(os.getenv("AUTO_SAVE_INTERVAL", "30"))  # seconds
+    persist_conversations: bool = os.getenv("PERSIST_CONVERSATIONS", "true").lower() == "true"
+    history_dir: str = os.getenv("HISTORY_DIR", "conversation_history_archives")  # monthly JSONL archives
     conversation_export_formats: List[str] = field(default_factory=lambda: os.getenv("CONVERSATION_EXPORT_FORMATS", "json,md,csv,txt").split(","))
     
     # Model Benchmarking
@@ -45,19 +94,7 @@ class Config:
     
     # Prompt Management
     enable_prompt_library: bool = os.getenv("ENABLE_PROMPT_LIBRARY", "true").lower() == "true"
-    default_prompts: Dict[str, str] = field(default_factory=lambda: {
-        "Default": "",
-        "Code Expert": "You are an expert programmer. Provide clean, well-commented code with explanations.",
-        "Creative Writer": "You are a creative writer. Use vivid imagery and engaging storytelling.",
-        "Teacher": "You are a patient teacher. Explain concepts clearly with examples.",
-        "Analyst": "You are a data analyst. Provide structured, evidence-based insights.",
-        "Debugger": "You are a debugging assistant. Help identify and fix code issues systematically.",
-        "Translator": "You are a professional translator. Provide accurate, context-aware translations.",
-        "Technical Writer": "You are a technical writer. Create clear, structured documentation.",
-        "Code Reviewer": "You are a code reviewer. Analyze code for best practices, security, and performance.",
-        "Tutor": "You are a personal tutor. Adapt your teaching style to the student's needs.",
-        "Research Assistant": "You are a research assistant. Help gather, analyze, and synthesize information."
-    })
+    default_prompts: Mapping[str, str] = field(default_factory=lambda: _DEFAULT_PROMPTS)
     
     # UI Customization
     message_bubble_style: str = os.getenv("MESSAGE_BUBBLE_STYLE", "rounded")  # rounded, square, minimal
@@ -69,34 +106,12 @@ class Config:
     track_response_times: bool = os.getenv("TRACK_RESPONSE_TIMES", "true").lower() == "true"
     track_token_usage: bool = os.getenv("TRACK_TOKEN_USAGE", "true").lower() == "true"
     
-    @property
+    @cached_property
     def ollama_base_url(self) -> str:
         return f"http://{self.ollama_host}:{self.ollama_port}"
     
-    @property
-    def theme_config(self) -> Dict[str, str]:
-        themes = {
-            "blue": {
-                "primary": "#0066cc",
-                "secondary": "#e3f2fd",
-                "accent": "#1976d2"
-            },
-            "green": {
-                "primary": "#2e7d32",
-                "secondary": "#e8f5e9",
-                "accent": "#388e3c"
-            },
-            "purple": {
-                "primary": "#6a1b9a",
-                "secondary": "#f3e5f5",
-                "accent": "#7b1fa2"
-            },
-            "orange": {
-                "primary": "#e65100",
-                "secondary": "#fff3e0",
-                "accent": "#ef6c00"
-            }
-        }
-        return themes.get(self.color_scheme, themes["blue"])
+    @cached_property
+    def theme_config(self) -> Mapping[str, str]:
+        return _THEMES.get(self.color_scheme, _THEMES["blue"])
 
-config = Config()
\ No newline at end of file
+config = Config()
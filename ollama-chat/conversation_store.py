@@ -0,0 +1,232 @@
+import json
+import mmap
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional
+
+# Metadata every index entry must carry for the conversation to be listed
+INDEX_FIELDS = ("title", "created_at", "last_modified")
+
+class ConversationStore:
+    """Append-only conversation archive, rotated into one JSONL file per month.
+
+    Each archive line is either a message ({conv_id, id, role, content, ts}) or
+    an operation on an existing conversation ({conv_id, op, ...}): an edit, a
+    truncation (regenerate) or a delete. Messages are rebuilt by replaying the
+    lines in order. Per-conversation metadata (title, timestamps, counts,
+    archive months) goes to an append-only index.jsonl, replayed (and
+    compacted) on startup, so conversations can be listed without reading any
+    messages.
+
+    One store is shared by every session of the app, each running on its own
+    thread, so writes and index reads take a lock. Archive files are only ever
+    appended to, so reading them happens outside it: a line still being
+    written is skipped like any other partial line.
+    """
+
+    def __init__(self, directory: str = "conversation_history_archives"):
+        self.directory = directory
+        self._index_path = os.path.join(directory, "index.jsonl")
+        self._lock = threading.RLock()
+        # Bumped on every archive write, so callers can tell when results
+        # they derived from the archive are stale
+        self.version = 0
+        os.makedirs(directory, exist_ok=True)
+        self._index = self._load_index()
+
+    def conversations(self) -> Dict[str, Dict]:
+        """Get metadata for every archived conversation"""
+        with self._lock:
+            return {conv_id: dict(meta) for conv_id, meta in self._index.items()}
+
+    def append_message(self, conv_id: str, message: Dict, meta: Dict):
+        """Archive a new message and update the conversation's metadata"""
+        self._write(conv_id, {
+            "id": message["id"],
+            "role": message["role"],
+            "content": message["content"],
+            "ts": message["timestamp"]
+        }, meta)
+
+    def edit_message(self, conv_id: str, msg_id: str, content: str):
+        """Record a new content for an archived message"""
+        self._write(conv_id, {"op": "edit", "id": msg_id, "content": content})
+
+    def truncate(self, conv_id: str, msg_id: str, meta: Dict):
+        """Drop the given message and every message after it"""
+        self._write(conv_id, {"op": "truncate", "from_id": msg_id}, meta)
+
+    def delete(self, conv_id: str):
+        """Delete a conversation; its archived lines are ignored from now on"""
+        with self._lock:
+            if conv_id in self._index:
+                self._write(conv_id, {"op": "delete"})
+                del self._index[conv_id]
+                self._append_index({"conv_id": conv_id, "deleted": True})
+
+    def load_messages(self, conv_id: str) -> List[Dict]:
+        """Rebuild a conversation's messages from its archive files"""
+        with self._lock:
+            months = list(self._index.get(conv_id, {}).get("months", []))
+
+        messages = []
+        for month in months:
+            for record in self._records(month):
+                if record.get("conv_id") == conv_id:
+                    self._replay(messages, record)
+        return messages
+
+    def search(self, query: str, conv_ids: Iterable[str]) -> Dict[str, List[Dict]]:
+        """Find archived messages of the given conversations containing query"""
+        query_lower = query.lower()
+        with self._lock:
+            conv_ids = set(conv_ids) & set(self._index)
+            months = {month for conv_id in conv_ids for month in self._index[conv_id].get("months", [])}
+
+        # Raw lines are only a cheap prefilter: they may hold edited or
+        # deleted content, so hits are confirmed against the replayed
+        # conversation
+        candidates = set()
+        for month in sorted(months):
+            for record in self._scan(month, query_lower):
+                if (record.get("conv_id") in conv_ids
+                        and query_lower in record.get("content", "").lower()):
+                    candidates.add(record["conv_id"])
+
+        results = {}
+        for conv_id in candidates:
+            matches = [m for m in self.load_messages(conv_id) if query_lower in m["content"].lower()]
+            if matches:
+                results[conv_id] = matches
+        return results
+
+    def _write(self, conv_id: str, record: Dict, meta: Optional[Dict] = None):
+        # Archives rotate on month boundaries: every line goes to the file of
+        # the month it is written in
+        month = datetime.now().strftime("%Y-%m")
+        with self._lock:
+            # Ops on a conversation the archive doesn't know (e.g. deleted
+            # from another session) are dropped, as is a new conversation
+            # written without its metadata
+            if conv_id not in self._index and ("op" in record or not self._complete(meta)):
+                return
+
+            with open(self._archive_path(month), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"conv_id": conv_id, **record}, ensure_ascii=False) + "\n")
+            self.version += 1
+
+            # Only changed metadata is logged, as the conversation's full entry
+            entry = self._index.setdefault(conv_id, {})
+            months = entry.setdefault("months", [])
+            if meta or month not in months:
+                if meta:
+                    entry.update(meta)
+                if month not in months:
+                    months.append(month)
+                self._append_index({"conv_id": conv_id, **entry})
+
+    @staticmethod
+    def _replay(messages: List[Dict], record: Dict):
+        op = record.get("op")
+        if op is None:
+            messages.append({
+                "role": record["role"],
+                "content": record["content"],
+                "timestamp": record["ts"],
+                "id": record["id"]
+            })
+        elif op == "edit":
+            for message in messages:
+                if message["id"] == record["id"]:
+                    message["content"] = record["content"]
+        elif op == "truncate":
+            for idx, message in enumerate(messages):
+                if message["id"] == record["from_id"]:
+                    del messages[idx:]
+                    break
+        elif op == "delete":
+            messages.clear()
+
+    def _records(self, month: str) -> Iterator[Dict]:
+        try:
+            with open(self._archive_path(month), encoding="utf-8") as f:
+                for line in f:
+                    record = self._parse(line)
+                    if record is not None:
+                        yield record
+        except OSError:
+            return
+
+    def _scan(self, month: str, query_lower: str) -> Iterator[Dict]:
+        # Lowercased raw bytes can only be compared with the query when it is
+        # plain ASCII without characters JSON escapes; otherwise parse all lines
+        needle = None
+        if query_lower.isascii() and query_lower.isprintable() and not any(c in query_lower for c in '"\\'):
+            needle = query_lower.encode()
+
+        try:
+            with open(self._archive_path(month), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for line in iter(mm.readline, b""):
+                        if needle is None or needle in line.lower():
+                            record = self._parse(line)
+                            if record is not None:
+                                yield record
+        except OSError:
+            return
+
+    @staticmethod
+    def _parse(line) -> Optional[Dict]:
+        try:
+            return json.loads(line)
+        except ValueError:
+            # A partially written line (e.g. the app was killed mid-write)
+            return None
+
+    def _archive_path(self, month: str) -> str:
+        return os.path.join(self.directory, f"{month}.jsonl")
+
+    def _load_index(self) -> Dict[str, Dict]:
+        # Replay the metadata log: each line holds a conversation's latest
+        # metadata or marks it deleted
+        index = {}
+        lines = 0
+        try:
+            with open(self._index_path, encoding="utf-8") as f:
+                for line in f:
+                    record = self._parse(line)
+                    if record is None:
+                        continue
+                    lines += 1
+                    conv_id = record.pop("conv_id", None)
+                    if conv_id is None:
+                        continue
+                    if record.get("deleted"):
+                        index.pop(conv_id, None)
+                    elif self._complete(record):
+                        index[conv_id] = record
+        except OSError:
+            pass
+
+        # Compact once the log is mostly superseded lines
+        if lines > 2 * len(index):
+            self._save_index(index)
+        return index
+
+    @staticmethod
+    def _complete(meta: Optional[Dict]) -> bool:
+        return bool(meta) and all(field in meta for field in INDEX_FIELDS)
+
+    def _append_index(self, record: Dict):
+        with open(self._index_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _save_index(self, index: Dict[str, Dict]):
+        tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for conv_id, meta in index.items():
+                f.write(json.dumps({"conv_id": conv_id, **meta}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self._index_path)
@@ -1,27 +1,136 @@
 import requests
-import json
+import orjson
 import time
-from typing import List, Dict, Generator, Optional, Tuple
+from typing import List, Dict, Generator, Optional, Tuple, Callable
 from datetime import datetime
 import asyncio
+import atexit
 import aiohttp
-from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import queue
+import threading
+from concurrent.futures import Future
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import config
+
+# Streamed text is handed out in batches of at least STREAM_COALESCE_CHARS
+# characters, or whatever arrived within STREAM_COALESCE_INTERVAL seconds, so
+# the UI repaints ~30 times a second instead of once per token
+STREAM_COALESCE_CHARS = 48
+STREAM_COALESCE_INTERVAL = 0.033
+
+# A successful availability probe is trusted for this many seconds
+AVAILABILITY_TTL = 10.0
+
+# A successfully fetched model list is reused for this many seconds
+MODELS_TTL = 30.0
+
+# Per-run metrics summarized by benchmark_model
+BENCHMARK_METRICS = ("response_time", "tokens_per_second", "total_duration", "eval_duration")
+
+# Embedding requests arriving within EMBED_BATCH_WINDOW seconds of each other
+# are sent to Ollama together
+EMBED_BATCH_WINDOW = 0.05
+
+class RequestBatcher:
+    """Collect items submitted from any thread and process them in batches.
+    
+    A daemon worker takes the first waiting item, then keeps collecting until
+    max_batch_size items are gathered or max_queue_time seconds have passed,
+    and hands the batch to process_batch, which returns one result per item.
+    Each submit() returns a Future for its own item's result.
+    """
+    
+    def __init__(self, process_batch: Callable[[List], List], max_batch_size: int,
+                 max_queue_time: float = EMBED_BATCH_WINDOW):
+        self._process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_queue_time = max_queue_time
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+    
+    def submit(self, item) -> Future:
+        """Queue an item for the next batch"""
+        future = Future()
+        self._queue.put((item, future))
+        return future
+    
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_queue_time
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                results = self._process_batch([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
 
 class OllamaClient:
     def __init__(self, base_url: str = "http://localhost:11434", timeout: int = 300):
         self.base_url = base_url
         self.timeout = timeout
-        self._session = None
+        self._async_timeout = aiohttp.ClientTimeout(total=timeout)
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._loop = None
+        self._available_at = float("-inf")
+        self._models_cache = []
+        self._models_ts = float("-inf")
+        self._embed_batcher = None
+        self._embed_batcher_lock = threading.Lock()
+        
+        # Pooled keep-alive session for all sync calls, so requests reuse
+        # connections instead of reconnecting each time. Only connection
+        # failures are retried; generation requests are never replayed.
+        self._sync_session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=max(8, config.concurrent_requests * 2),
+            pool_block=False,
+            max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.2)
+        )
+        self._sync_session.mount("http://", adapter)
+        self._sync_session.mount("https://", adapter)
+        # identity: a gzip-encoded stream would be buffered, breaking token streaming
+        self._sync_session.headers.update({
+            "Content-Type": "application/json",
+            "Accept-Encoding": "identity"
+        })
         
     def list_models(self) -> List[str]:
         """Get list of available models"""
+        # Failed fetches aren't cached, so they are retried on the next call
+        now = time.monotonic()
+        if now - self._models_ts < MODELS_TTL:
+            return list(self._models_cache)
+        
         try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=10)
+            response = self._sync_session.get(f"{self.base_url}/api/tags", timeout=10)
             response.raise_for_status()
-            models = response.json().get("models", [])
-            return [model["name"] for model in models]
-        except requests.RequestException:
+            models = orjson.loads(response.content).get("models", [])
+        except (requests.RequestException, orjson.JSONDecodeError):
             return []
+        
+        self._models_cache = [model["name"] for model in models]
+        self._models_ts = now
+        return list(self._models_cache)
+    
+    def clear_model_cache(self):
+        """Forget the cached model list, e.g. after pulling a model"""
+        self._models_ts = float("-inf")
     
     def chat_stream(self, model: str, messages: List[Dict], **kwargs) -> Generator[str, None, None]:
         """Stream chat responses from Ollama"""
@@ -33,19 +142,110 @@ class OllamaClient:
         }
         
         try:
-            response = requests.post(
+            response = self._sync_session.post(
                 f"{self.base_url}/api/chat",
-                json=payload,
+                data=orjson.dumps(payload),
                 stream=True,
                 timeout=self.timeout
             )
             response.raise_for_status()
             
-            for line in response.iter_lines():
-                if line:
-                    chunk = json.loads(line.decode('utf-8'))
-                    if chunk.get("message", {}).get("content"):
-                        yield chunk["message"]["content"]
+            # The finally also runs when the caller closes the generator
+            # early, releasing the connection
+            try:
+                yield from self._coalesce(
+                    chunk.get("message", {}).get("content")
+                    for chunk in self._iter_ndjson(response)
+                )
+            finally:
+                response.close()
+                        
+        except requests.RequestException as e:
+            yield f"Error: {str(e)}"
+    
+    @staticmethod
+    def _coalesce(pieces) -> Generator[str, None, None]:
+        """Join small streamed pieces into fewer, larger ones"""
+        pending = []
+        pending_len = 0
+        last_flush = time.monotonic()
+        try:
+            for piece in pieces:
+                if not piece:
+                    continue
+                pending.append(piece)
+                pending_len += len(piece)
+                now = time.monotonic()
+                if pending_len >= STREAM_COALESCE_CHARS or now - last_flush >= STREAM_COALESCE_INTERVAL:
+                    yield "".join(pending)
+                    pending.clear()
+                    pending_len = 0
+                    last_flush = now
+        except requests.RequestException:
+            # Hand out what was received before the connection broke
+            if pending:
+                yield "".join(pending)
+            raise
+        
+        if pending:
+            yield "".join(pending)
+    
+    @staticmethod
+    def _iter_ndjson(response) -> Generator[Dict, None, None]:
+        """Parse a streamed NDJSON response straight from the raw bytes"""
+        buf = bytearray()
+        # chunk_size=None hands over data as soon as it arrives
+        for data in response.iter_content(chunk_size=None):
+            buf += data
+            start = 0
+            while True:
+                end = buf.find(b"\n", start)
+                if end < 0:
+                    break
+                line = buf[start:end]
+                start = end + 1
+                if line.strip():
+                    yield orjson.loads(line)
+            del buf[:start]
+        
+        if buf.strip():
+            yield orjson.loads(buf)
+    
+    def generate_stream(self, model: str, prompt: str, context: Optional[List[int]] = None,
+                        on_context: Optional[Callable[[List[int]], None]] = None,
+                        **kwargs) -> Generator[str, None, None]:
+        """Stream a completion, continuing from a previous context.
+        
+        Ollama returns the conversation's token context on the final chunk;
+        it is passed to on_context so the next turn can resume from it instead
+        of resending (and re-evaluating) the whole history.
+        """
+        payload = {
+            "model": model,
+            "prompt": prompt,
+            "stream": True,
+            **kwargs
+        }
+        if context:
+            payload["context"] = context
+        
+        try:
+            response = self._sync_session.post(
+                f"{self.base_url}/api/generate",
+                data=orjson.dumps(payload),
+                stream=True,
+                timeout=self.timeout
+            )
+            response.raise_for_status()
+            
+            try:
+                for chunk in self._iter_ndjson(response):
+                    if chunk.get("response"):
+                        yield chunk["response"]
+                    if chunk.get("done") and chunk.get("context") and on_context:
+                        on_context(chunk["context"])
+            finally:
+                response.close()
                         
         except requests.RequestException as e:
             yield f"Error: {str(e)}"
@@ -60,14 +260,14 @@ class OllamaClient:
         }
         
         try:
-            response = requests.post(
+            response = self._sync_session.post(
                 f"{self.base_url}/api/chat", 
-                json=payload,
+                data=orjson.dumps(payload),
                 timeout=self.timeout
             )
             response.raise_for_status()
-            return response.json()["message"]["content"]
-        except requests.RequestException as e:
+            return orjson.loads(response.content)["message"]["content"]
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
             return f"Error: {str(e)}"
     
     def chat_with_metrics(self, model: str, messages: List[Dict], **kwargs) -> Tuple[str, Dict]:
@@ -82,15 +282,15 @@ class OllamaClient:
         }
         
         try:
-            response = requests.post(
+            response = self._sync_session.post(
                 f"{self.base_url}/api/chat", 
-                json=payload,
+                data=orjson.dumps(payload),
                 timeout=self.timeout
             )
             response.raise_for_status()
             
             end_time = time.time()
-            response_data = response.json()
+            response_data = orjson.loads(response.content)
             
             content = response_data["message"]["content"]
             
@@ -108,13 +308,17 @@ class OllamaClient:
             
             return content, metrics
             
-        except requests.RequestException as e:
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
             return f"Error: {str(e)}", {"error": str(e)}
     
     async def chat_async(self, model: str, messages: List[Dict], **kwargs) -> str:
-        """Async chat for concurrent requests"""
-        if not self._session:
-            self._session = aiohttp.ClientSession()
+        """Async chat for concurrent requests.
+        
+        The connection pool of the running loop is closed when asyncio.run()
+        finishes; loops managed by hand should use `async with client` so it
+        is closed before the loop is.
+        """
+        session, semaphore = self._session_for(asyncio.get_running_loop())
         
         payload = {
             "model": model,
@@ -124,36 +328,95 @@ class OllamaClient:
         }
         
         try:
-            async with self._session.post(
-                f"{self.base_url}/api/chat",
-                json=payload,
-                timeout=aiohttp.ClientTimeout(total=self.timeout)
-            ) as response:
-                response.raise_for_status()
-                data = await response.json()
-                return data["message"]["content"]
+            # Requests past the in-flight cap wait here instead of piling
+            # onto the server
+            async with semaphore:
+                async with session.post(
+                    f"{self.base_url}/api/chat",
+                    data=orjson.dumps(payload),
+                    timeout=self._async_timeout
+                ) as response:
+                    response.raise_for_status()
+                    data = orjson.loads(await response.read())
+                    return data["message"]["content"]
         except Exception as e:
             return f"Error: {str(e)}"
     
-    def compare_models(self, models: List[str], messages: List[Dict], **kwargs) -> Dict[str, str]:
-        """Compare responses from multiple models"""
-        responses = {}
-        
-        with ThreadPoolExecutor(max_workers=len(models)) as executor:
-            futures = {
-                executor.submit(self.chat, model, messages, **kwargs): model 
-                for model in models
-            }
+    def _session_for(self, loop: asyncio.AbstractEventLoop) -> Tuple[aiohttp.ClientSession, asyncio.Semaphore]:
+        """Get the pooled session and request semaphore of an event loop"""
+        # Both are bound to the loop they are created in, so every loop gets
+        # its own pair; pairs of loops that have since closed are dropped
+        with self._sessions_lock:
+            for closed_loop in [other for other in self._sessions if other.is_closed()]:
+                del self._sessions[closed_loop]
             
-            for future in futures:
-                model = futures[future]
-                try:
-                    response = future.result()
-                    responses[model] = response
-                except Exception as e:
-                    responses[model] = f"Error: {str(e)}"
+            entry = self._sessions.get(loop)
+            if entry is None or entry[0].closed:
+                session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(
+                        limit=config.concurrent_requests,
+                        limit_per_host=config.concurrent_requests,
+                        keepalive_timeout=60
+                    ),
+                    headers={"Content-Type": "application/json"}
+                )
+                # The background loop's session is closed at exit instead
+                closer = None if loop is self._loop else loop.create_task(self._close_at_shutdown(session))
+                entry = (session, asyncio.Semaphore(config.max_in_flight), closer)
+                self._sessions[loop] = entry
+            return entry[0], entry[1]
+    
+    async def _close_at_shutdown(self, session: aiohttp.ClientSession):
+        # Waits until cancelled, which asyncio.run() does to leftover tasks
+        # before closing its loop, then closes the loop's session
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.create_future()
+        finally:
+            with self._sessions_lock:
+                entry = self._sessions.get(loop)
+                if entry and entry[0] is session:
+                    del self._sessions[loop]
+            await session.close()
+    
+    def _background_loop(self) -> asyncio.AbstractEventLoop:
+        # A long-lived loop for the sync wrappers, so their session (and its
+        # open connections) is reused from one call to the next
+        with self._sessions_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, daemon=True).start()
+                atexit.register(self._close_background_session)
+            return self._loop
+    
+    def _close_background_session(self):
+        entry = self._sessions.get(self._loop)
+        if entry and not entry[0].closed:
+            try:
+                asyncio.run_coroutine_threadsafe(entry[0].close(), self._loop).result(timeout=5)
+            except Exception:
+                pass
+    
+    async def _compare_async(self, models: List[str], messages: List[Dict], **kwargs) -> Dict[str, str]:
+        results = await asyncio.gather(
+            *(self.chat_async(model, messages, **kwargs) for model in models),
+            return_exceptions=True
+        )
         
-        return responses
+        return {
+            model: f"Error: {str(result)}" if isinstance(result, BaseException) else result
+            for model, result in zip(models, results)
+        }
+    
+    def compare_models(self, models: List[str], messages: List[Dict], **kwargs) -> Dict[str, str]:
+        """Compare responses from multiple models"""
+        # All requests share one connection pool and run concurrently on a
+        # single event loop instead of one thread each
+        future = asyncio.run_coroutine_threadsafe(
+            self._compare_async(models, messages, **kwargs),
+            self._background_loop()
+        )
+        return future.result()
     
     def benchmark_model(self, model: str, test_prompt: str = "Hello, how are you?", 
                        iterations: int = 3) -> Dict[str, float]:
@@ -173,29 +436,36 @@ class OllamaClient:
         if not metrics_list:
             return {"error": "All benchmark attempts failed"}
         
-        # Calculate averages
-        avg_metrics = {
+        # One row per run, one column per metric; mean, spread and tail
+        # latency are then computed column-wise in a single pass each
+        samples = np.array([[m[key] for key in BENCHMARK_METRICS] for m in metrics_list], dtype=float)
+        means = samples.mean(axis=0)
+        stds = samples.std(axis=0)
+        p50s, p95s = np.percentile(samples, [50, 95], axis=0)
+        
+        benchmark = {
             "model": model,
             "iterations": len(metrics_list),
-            "avg_response_time": sum(m["response_time"] for m in metrics_list) / len(metrics_list),
-            "avg_tokens_per_second": sum(m["tokens_per_second"] for m in metrics_list) / len(metrics_list),
-            "avg_total_duration": sum(m["total_duration"] for m in metrics_list) / len(metrics_list),
-            "avg_eval_duration": sum(m["eval_duration"] for m in metrics_list) / len(metrics_list),
         }
+        for idx, key in enumerate(BENCHMARK_METRICS):
+            benchmark[f"avg_{key}"] = float(means[idx])
+            benchmark[f"std_{key}"] = float(stds[idx])
+            benchmark[f"p50_{key}"] = float(p50s[idx])
+            benchmark[f"p95_{key}"] = float(p95s[idx])
         
-        return avg_metrics
+        return benchmark
     
     def get_model_info(self, model_name: str) -> Dict:
         """Get detailed information about a specific model"""
         try:
-            response = requests.post(
+            response = self._sync_session.post(
                 f"{self.base_url}/api/show",
-                json={"name": model_name},
+                data=orjson.dumps({"name": model_name}),
                 timeout=30
             )
             response.raise_for_status()
-            return response.json()
-        except requests.RequestException:
+            return orjson.loads(response.content)
+        except (requests.RequestException, orjson.JSONDecodeError):
             return {}
     
     def get_model_details(self, model_name: str) -> Dict:
@@ -228,9 +498,9 @@ class OllamaClient:
     def unload_model(self, model: str) -> bool:
         """Unload model from memory to free up resources"""
         try:
-            requests.post(
+            self._sync_session.post(
                 f"{self.base_url}/api/generate",
-                json={"model": model, "keep_alive": 0},
+                data=orjson.dumps({"model": model, "keep_alive": 0}),
                 timeout=30
             )
             return True
@@ -240,9 +510,9 @@ class OllamaClient:
     def keep_model_loaded(self, model: str, duration: int = 3600) -> bool:
         """Keep a model loaded in memory for specified duration (seconds)"""
         try:
-            requests.post(
+            self._sync_session.post(
                 f"{self.base_url}/api/generate",
-                json={"model": model, "keep_alive": duration},
+                data=orjson.dumps({"model": model, "keep_alive": duration}),
                 timeout=30
             )
             return True
@@ -251,41 +521,72 @@ class OllamaClient:
     
     def generate_embeddings(self, model: str, prompt: str) -> Optional[List[float]]:
         """Generate embeddings for a given prompt"""
-        try:
-            response = requests.post(
-                f"{self.base_url}/api/embeddings",
-                json={"model": model, "prompt": prompt},
-                timeout=30
-            )
-            response.raise_for_status()
-            return response.json().get("embedding")
-        except requests.RequestException:
-            return None
+        # Concurrent calls (e.g. from several sessions) are batched into one
+        # /api/embed request per model
+        with self._embed_batcher_lock:
+            if self._embed_batcher is None:
+                self._embed_batcher = RequestBatcher(self._embed_batch, max_batch_size=config.concurrent_requests)
+        return self._embed_batcher.submit((model, prompt)).result()
+    
+    def _embed_batch(self, items: List[Tuple[str, str]]) -> List[Optional[List[float]]]:
+        by_model = {}
+        for idx, (model, prompt) in enumerate(items):
+            by_model.setdefault(model, []).append(idx)
+        
+        results = [None] * len(items)
+        for model, indices in by_model.items():
+            try:
+                response = self._sync_session.post(
+                    f"{self.base_url}/api/embed",
+                    data=orjson.dumps({"model": model, "input": [items[idx][1] for idx in indices]}),
+                    timeout=30
+                )
+                response.raise_for_status()
+                embeddings = orjson.loads(response.content).get("embeddings", [])
+            except (requests.RequestException, orjson.JSONDecodeError):
+                continue
+            for idx, embedding in zip(indices, embeddings):
+                results[idx] = embedding
+        return results
     
     def is_available(self) -> bool:
         """Check if Ollama server is running"""
+        # Only successes are cached, so a server that went down is noticed
+        # within AVAILABILITY_TTL and one that came back on the next call
+        now = time.monotonic()
+        if now - self._available_at < AVAILABILITY_TTL:
+            return True
+        
         try:
-            response = requests.get(f"{self.base_url}/api/tags", timeout=5)
-            return response.status_code == 200
+            response = self._sync_session.get(f"{self.base_url}/api/tags", timeout=5)
+            available = response.status_code == 200
         except:
-            return False
+            available = False
+        
+        self._available_at = now if available else float("-inf")
+        return available
     
     def get_server_version(self) -> Optional[str]:
         """Get Ollama server version"""
         try:
-            response = requests.get(f"{self.base_url}/api/version", timeout=5)
+            response = self._sync_session.get(f"{self.base_url}/api/version", timeout=5)
             response.raise_for_status()
-            return response.json().get("version")
+            return orjson.loads(response.content).get("version")
         except:
             return None
     
     async def __aenter__(self):
         """Async context manager entry"""
-        self._session = aiohttp.ClientSession()
+        self._session_for(asyncio.get_running_loop())
         return self
     
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """Async context manager exit"""
-        if self._session:
-            await self._session.close()
-            self._session = None
\ No newline at end of file
+        with self._sessions_lock:
+            entry = self._sessions.pop(asyncio.get_running_loop(), None)
+        if entry:
+            session, _, closer = entry
+            if closer is not None:
+                closer.cancel()
+                await asyncio.wait([closer])
+            await session.close()
\ No newline at end of file